@@ -16,7 +16,7 @@
  * 4. SPEED: ~0.1ms operations
  */
 
-const { redis, scanKeys, mgetParsed } = require('./redisClient');
+const { redis, scanKeys, mgetParsed, bumpGrantsVersion } = require('./redisClient');
 
 // Permission types that can be granted
 const PERMISSION_TYPES = {
@@ -90,6 +90,7 @@ class AccessControlService {
       if (currentTtl < ttlSeconds) {
         await redis.expire(userGrantsKey, ttlSeconds);
       }
+      await bumpGrantsVersion();
       
       console.log(`[Access Control] Granted access to user ${userId} for document ${documentId}`);
       console.log(`[Access Control] Permissions: ${validPermissions.join(', ')}`);
@@ -181,6 +182,7 @@ class AccessControlService {
       await redis.srem(this._userGrantsKey(userId), String(documentId));
       
       if (deleted) {
+        await bumpGrantsVersion();
         console.log(`[Access Control] Revoked access for user ${userId} to document ${documentId}`);
       }
       return deleted > 0;
@@ -17,7 +17,7 @@
  */
 
 const axios = require('axios');
-const { redis } = require('./redisClient');
+const { redis, bumpGrantsVersion } = require('./redisClient');
 const { MAYAN_URL } = require('../config/mayan');
 
 // Configuration
@@ -282,6 +282,8 @@ async function getAuthHeaders(userContext = null) {
 async function cacheMayanUserId(keycloakUserId, mayanUserId) {
   const cacheKey = `${USER_CACHE_PREFIX}${keycloakUserId}`;
   await redis.setex(cacheKey, TOKEN_TTL * 24, String(mayanUserId)); // 24 hour cache
+  // A new mapping can make previously skipped grants syncable in Mayan.
+  await bumpGrantsVersion();
   console.log(`[MayanAuth] Cached Mayan user ID mapping: ${keycloakUserId} → ${mayanUserId}`);
 }
 
@@ -112,6 +112,16 @@ async function mgetParsed(keys) {
   }));
 }
 
+/**
+ * Bump the grant-set version read by Mayan's periodic ACL sync.
+ * The sync skips its full pass while this value is unchanged.
+ */
+const GRANTS_VERSION_KEY = 'grants:version';
+
+async function bumpGrantsVersion() {
+  return redis.incr(GRANTS_VERSION_KEY);
+}
+
 // Graceful shutdown
 process.on('SIGTERM', async () => {
   console.log('[Redis] Shutting down...');
@@ -123,5 +133,7 @@ module.exports = {
   redis,
   redisPubSub,
   scanKeys,
-  mgetParsed
+  mgetParsed,
+  GRANTS_VERSION_KEY,
+  bumpGrantsVersion
 };
@@ -1,13 +1,17 @@
 from __future__ import annotations
 
+import functools
 import json
 import os
+import time
 from dataclasses import dataclass
+from datetime import datetime
 
 import redis
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
 
 
 @dataclass(frozen=True)
@@ -15,9 +19,24 @@ class Grant:
     user_id: str
     document_id: int
     permissions: tuple[str, ...]
+    expires_at: float | None = None
+
+
+# Bumped by the backend on every grant/mapping change (see redisClient.js).
+GRANTS_VERSION_KEY = "grants:version"
+
+# (grants:version, earliest grant expiry) recorded by the last completed sync.
+_LAST_SYNC: tuple[str, float] | None = None
+
+_REDIS_CLIENT: redis.Redis | None = None
 
 
 def _get_redis_client() -> redis.Redis:
+    # Reuse one pooled client per process instead of reconnecting on every sync.
+    global _REDIS_CLIENT
+    if _REDIS_CLIENT is not None:
+        return _REDIS_CLIENT
+
     # Backend uses Redis DB 0 by default. Mayan also has a redis service.
     url = (
         os.environ.get("COFFRE_FORT_REDIS_URL")
@@ -28,38 +47,122 @@ def _get_redis_client() -> redis.Redis:
     )
     if not url.startswith("redis://") and not url.startswith("rediss://"):
         url = "redis://redis:6379/0"
-    return redis.Redis.from_url(url, decode_responses=True)
+    pool = redis.ConnectionPool.from_url(url, max_connections=16, decode_responses=True)
+    _REDIS_CLIENT = redis.Redis(connection_pool=pool)
+    return _REDIS_CLIENT
+
+
+def _fetch_values(r: redis.Redis, keys: list[str]) -> list:
+    try:
+        return r.mget(keys)
+    except redis.ResponseError:
+        # MGET can be refused (e.g. cross-slot keys behind a cluster proxy).
+        # Fall back to pipelined GETs: still one round-trip, and a failing key
+        # only yields an error entry instead of failing the whole batch.
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        return pipe.execute(raise_on_error=False)
+
+
+def _fetch_ttl_expiries(r: redis.Redis, keys: list[str]) -> dict[str, float | None]:
+    # Absolute expiry of each key from its Redis TTL, in one pipelined round-trip.
+    # Keys without a TTL (or already gone) map to None.
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.pttl(key)
+    now = time.time()
+    return {
+        key: now + ttl / 1000 if isinstance(ttl, int) and ttl >= 0 else None
+        for key, ttl in zip(keys, pipe.execute(raise_on_error=False))
+    }
 
 
-def _iter_grants(r: redis.Redis):
-    # Keys are written by backend/services/accessControl.js
-    for key in r.scan_iter(match="grant:*", count=1000):
+def _grant_key_parts(key: str) -> tuple[str, str]:
+    # grant:{userId}:{documentId}; userId may itself contain ':'.
+    user_id, _, document_id = key[len("grant:"):].rpartition(":")
+    return user_id, document_id
+
+
+def _grant_expiry(payload: dict) -> float | None:
+    if not payload.get("expiresAt"):
+        return None
+    return datetime.fromisoformat(str(payload["expiresAt"]).replace("Z", "+00:00")).timestamp()
+
+
+def _parse_grants(
+    keys: list[str],
+    values: list[str | None],
+    mayan_user_ids: dict | None = None,
+    ttl_expiries: dict | None = None,
+):
+    for key, raw in zip(keys, values):
         try:
-            raw = r.get(key)
-            if not raw:
+            if not raw or not isinstance(raw, str):
+                continue
+            # userId/documentId come from the key (grant:{userId}:{documentId});
+            # the JSON payload is only needed for permissions and expiry.
+            user_id, document_id = _grant_key_parts(key)
+            if not user_id:
+                continue
+            if mayan_user_ids is not None and not mayan_user_ids.get(user_id):
+                # Grants of users without a Mayan mapping are only counted as
+                # skipped later on, so don't decode their payload at all. Their
+                # expiry still matters for _LAST_SYNC (they keep existing kc:
+                # role ACLs alive), so it comes from the key's TTL instead.
+                expires_at = (ttl_expiries or {}).get(key)
+                yield Grant(user_id=user_id, document_id=int(document_id), permissions=(), expires_at=expires_at)
                 continue
             payload = json.loads(raw)
-            user_id = str(payload.get("userId") or "").strip()
-            document_id = int(payload.get("documentId"))
+            expires_at = _grant_expiry(payload)
             perms = payload.get("permissions") or ["view"]
             if isinstance(perms, str):
                 perms = [perms]
             perms = tuple(str(p) for p in perms if p)
-            if not user_id:
-                continue
-            yield Grant(user_id=user_id, document_id=document_id, permissions=perms)
+            yield Grant(user_id=user_id, document_id=int(document_id), permissions=perms, expires_at=expires_at)
         except Exception:
             continue
 
 
-def _permission_keys_for_grant(grant: Grant) -> set[str]:
+def _iter_grants(r: redis.Redis, count: int = 5000, mayan_user_ids: dict | None = None):
+    # Keys are written by backend/services/accessControl.js
+    # Payloads are fetched with one MGET per SCAN-sized chunk instead of one GET
+    # per key. Grants are plain strings, so let Redis (>= 6.0) skip other types.
+    # When `mayan_user_ids` is given, it is filled with the mayan:user:{userId}
+    # mapping of every user seen, fetched alongside each chunk; grants of
+    # unmapped users get their expiry from one pipelined PTTL per chunk.
+    def _flush(keys: list[str]):
+        ttl_expiries = None
+        if mayan_user_ids is not None:
+            new_users = list({_grant_key_parts(key)[0] for key in keys} - mayan_user_ids.keys())
+            if new_users:
+                mayan_user_ids.update(
+                    zip(new_users, _fetch_values(r, [f"mayan:user:{u}" for u in new_users]))
+                )
+            unmapped = [key for key in keys if not mayan_user_ids.get(_grant_key_parts(key)[0])]
+            if unmapped:
+                ttl_expiries = _fetch_ttl_expiries(r, unmapped)
+        return _parse_grants(keys, _fetch_values(r, keys), mayan_user_ids, ttl_expiries)
+
+    buffer: list[str] = []
+    for key in r.scan_iter(match="grant:*", count=count, _type="string"):
+        buffer.append(key)
+        if len(buffer) >= count:
+            yield from _flush(buffer)
+            buffer = []
+
+    if buffer:
+        yield from _flush(buffer)
+
+
+def _permission_keys_for_grant(permissions: frozenset[str]) -> set[str]:
     # Minimum required for the document to appear in Mayan UI.
     keys: set[str] = {"documents.document_view", "documents.document_file_view"}
 
-    if "download" in grant.permissions:
+    if "download" in permissions:
         keys.add("document_downloads.document_file_download")
 
-    if "ocr" in grant.permissions:
+    if "ocr" in permissions:
         # View extracted content.
         keys.add("document_parsing.content_view")
 
@@ -67,115 +170,259 @@ def _permission_keys_for_grant(grant: Grant) -> set[str]:
     return keys
 
 
-def _get_stored_permissions(permission_keys: set[str]):
+# "namespace.name" -> StoredPermission, refreshed once per sync.
+_PERM_CACHE: dict = {}
+
+
+def _load_stored_permissions() -> None:
     from mayan.apps.permissions.models import StoredPermission
 
+    # The permissions table is tiny; one query replaces a lookup per grant.
+    _PERM_CACHE.clear()
+    _resolve_perms.cache_clear()
+    for perm in StoredPermission.objects.all():
+        _PERM_CACHE[f"{perm.namespace}.{perm.name}"] = perm
+
+
+def _get_stored_permissions(permission_keys: set[str]):
     perms = []
     for key in sorted(permission_keys):
-        try:
-            namespace, name = key.split(".", 1)
-            perms.append(StoredPermission.objects.get(namespace=namespace, name=name))
-        except Exception:
+        perm = _PERM_CACHE.get(key)
+        if perm is None:
             # Skip unknown permissions (Mayan version differences).
             continue
+        perms.append(perm)
     return perms
 
 
-def _ensure_user_group_role(user_id: str, mayan_user_id: int):
+@functools.lru_cache(maxsize=32)
+def _resolve_perms(permissions: frozenset[str]) -> tuple:
+    # Only a handful of distinct permission combinations exist, so most
+    # grants resolve to their StoredPermissions with a single cache hit.
+    return tuple(_get_stored_permissions(_permission_keys_for_grant(permissions)))
+
+
+def _ensure_user_groups_roles(mayan_user_ids_by_user: dict[str, int]) -> dict[str, object]:
     # Create a dedicated group + role per Keycloak user.
     # This allows per-document ACLs while keeping changes scoped.
+    # Everything is done with a constant number of bulk queries regardless of
+    # the number of users; existing rows are left alone via ignore_conflicts.
     from mayan.apps.permissions.models import Role
 
-    label = f"kc:{user_id}"[:128]
-    group, _ = Group.objects.get_or_create(name=label)
-    role, _ = Role.objects.get_or_create(label=label)
-    role.groups.add(group)
-
     User = get_user_model()
-    user = User.objects.get(pk=mayan_user_id)
-    user.groups.add(group)
-    return role
+    existing_user_pks = set(
+        User.objects.filter(pk__in=set(mayan_user_ids_by_user.values())).values_list("pk", flat=True)
+    )
+    labels = {
+        user_id: f"kc:{user_id}"[:128]
+        for user_id, mayan_user_id in mayan_user_ids_by_user.items()
+        if mayan_user_id in existing_user_pks
+    }
+    if not labels:
+        return {}
+
+    Group.objects.bulk_create([Group(name=label) for label in labels.values()], ignore_conflicts=True)
+    Role.objects.bulk_create([Role(label=label) for label in labels.values()], ignore_conflicts=True)
+    groups = {g.name: g for g in Group.objects.filter(name__in=labels.values())}
+    roles = {r.label: r for r in Role.objects.filter(label__in=labels.values())}
+
+    RoleGroup = Role.groups.through
+    RoleGroup.objects.bulk_create(
+        [RoleGroup(role_id=roles[label].pk, group_id=groups[label].pk) for label in labels.values()],
+        ignore_conflicts=True,
+    )
+    UserGroup = User.groups.through
+    UserGroup.objects.bulk_create(
+        [
+            UserGroup(user_id=mayan_user_ids_by_user[user_id], group_id=groups[label].pk)
+            for user_id, label in labels.items()
+        ],
+        ignore_conflicts=True,
+    )
+    return {user_id: roles[label] for user_id, label in labels.items()}
+
+
+def _delete_stale_acls(document_ct, desired_by_role: dict[int, set[int]]) -> int:
+    # One SELECT to find stale ACLs across all managed roles, then raw DELETEs
+    # that skip row materialization and pre/post_delete signals. This is safe
+    # because the only dependent rows of an ACL are its permissions M2M rows,
+    # which are removed explicitly first.
+    from django.db import router
 
+    from mayan.apps.acls.models import AccessControlList
+
+    if not desired_by_role:
+        return 0
+
+    rows = AccessControlList.objects.filter(
+        content_type=document_ct, role_id__in=list(desired_by_role)
+    ).values_list("pk", "role_id", "object_id")
+    stale_pks = [
+        pk for pk, role_pk, object_id in rows
+        if int(object_id) not in desired_by_role.get(role_pk, ())
+    ]
+    if not stale_pks:
+        return 0
+
+    using = router.db_for_write(AccessControlList)
+    Through = AccessControlList.permissions.through
+    Through.objects.filter(accesscontrollist_id__in=stale_pks)._raw_delete(using=using)
+    return AccessControlList.objects.filter(pk__in=stale_pks)._raw_delete(using=using)
+
+
+def _upsert_acls(document_ct, desired_acls: dict[tuple[int, int], set[int]]) -> tuple[int, int]:
+    # Bulk equivalent of get_or_create + permissions.set() per grant:
+    # one SELECT for existing ACLs, one bulk INSERT for missing ones, then a
+    # diff of the permissions through table applied with bulk insert/delete.
+    from mayan.apps.acls.models import AccessControlList
 
-def sync_acl_from_redis() -> dict[str, int]:
+    if not desired_acls:
+        return 0, 0
+
+    role_pks = {role_pk for role_pk, _ in desired_acls}
+
+    def _existing_acls() -> dict[tuple[int, int], int]:
+        rows = AccessControlList.objects.filter(
+            content_type=document_ct, role_id__in=role_pks
+        ).values_list("role_id", "object_id", "pk")
+        return {(role_pk, int(object_id)): pk for role_pk, object_id, pk in rows}
+
+    acl_pks = _existing_acls()
+    missing = [key for key in desired_acls if key not in acl_pks]
+    if missing:
+        AccessControlList.objects.bulk_create(
+            [
+                AccessControlList(content_type=document_ct, object_id=document_id, role_id=role_pk)
+                for role_pk, document_id in missing
+            ],
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+        # ignore_conflicts leaves PKs unset; reload them.
+        acl_pks = _existing_acls()
+
+    Through = AccessControlList.permissions.through
+    desired_rows = {
+        (acl_pks[key], perm_pk)
+        for key, perm_pks in desired_acls.items()
+        if key in acl_pks
+        for perm_pk in perm_pks
+    }
+    managed_acl_pks = {acl_pks[key] for key in desired_acls if key in acl_pks}
+
+    existing_rows: dict[tuple[int, int], int] = {}
+    for pk, acl_pk, perm_pk in Through.objects.filter(
+        accesscontrollist_id__in=managed_acl_pks
+    ).values_list("pk", "accesscontrollist_id", "storedpermission_id"):
+        existing_rows[(acl_pk, perm_pk)] = pk
+
+    to_add = desired_rows - existing_rows.keys()
+    if to_add:
+        Through.objects.bulk_create(
+            [Through(accesscontrollist_id=acl_pk, storedpermission_id=perm_pk) for acl_pk, perm_pk in to_add],
+            batch_size=500,
+            ignore_conflicts=True,
+        )
+
+    to_remove = [pk for row, pk in existing_rows.items() if row not in desired_rows]
+    if to_remove:
+        Through.objects.filter(pk__in=to_remove).delete()
+
+    return len(missing), len(desired_acls) - len(missing)
+
+
+def sync_acl_from_redis(force: bool = False) -> dict[str, int]:
     """Mirror backend Redis grants into Mayan's ACL table.
 
     - Reads backend grants: grant:{userId}:{documentId}
     - Uses backend mapping: mayan:user:{userId} -> Mayan user ID
     - Creates per-user Role+Group (kc:{userId})
     - Adds/removes AccessControlList entries per document
+
+    The full pass is skipped while grants:version is unchanged and no synced
+    grant has expired since the last run, unless ``force`` is set.
     """
 
-    from mayan.apps.acls.models import AccessControlList
+    global _LAST_SYNC
 
     r = _get_redis_client()
 
-    # Map: userId -> list(grants)
+    version = r.get(GRANTS_VERSION_KEY)
+    if not force and version is not None and _LAST_SYNC is not None:
+        last_version, next_expiry = _LAST_SYNC
+        if version == last_version and time.time() < next_expiry:
+            return {"created": 0, "updated": 0, "deleted": 0, "skipped": 0}
+
+    # Map: userId -> list(grants), in a single SCAN over grant:* keys.
+    # Map: userId -> raw mayan:user:{userId} value, filled while scanning.
     grants_by_user: dict[str, list[Grant]] = {}
-    for grant in _iter_grants(r):
+    mayan_user_ids: dict[str, str | None] = {}
+    for grant in _iter_grants(r, mayan_user_ids=mayan_user_ids):
         grants_by_user.setdefault(grant.user_id, []).append(grant)
 
-    # Only manage ACLs for Document objects.
-    document_ct = ContentType.objects.get(app_label="documents", model="document")
-
-    created = 0
-    updated = 0
-    deleted = 0
-    skipped = 0
-
-    from mayan.apps.permissions.models import Role
-
-    # 1) Remove stale ACLs even when a user's last grant expired/revoked.
-    # We manage only our own roles (prefix kc:).
-    managed_roles = Role.objects.filter(label__startswith='kc:')
-    for role in managed_roles:
-        role_user_id = (role.label or '')[3:]
-        desired_doc_ids = {g.document_id for g in grants_by_user.get(role_user_id, [])}
+    # Apply all DB changes in one transaction: a single commit instead of one per write.
+    with transaction.atomic():
+        _load_stored_permissions()
+
+        # Only manage ACLs for Document objects.
+        # get_by_natural_key() is served from ContentType's in-process cache.
+        document_ct = ContentType.objects.get_by_natural_key("documents", "document")
+
+        from mayan.apps.permissions.models import Role
+
+        # 1) Remove stale ACLs even when a user's last grant expired/revoked.
+        # We manage only our own roles (prefix kc:).
+        desired_by_role = {
+            role.pk: {g.document_id for g in grants_by_user.get((role.label or '')[3:], [])}
+            for role in Role.objects.filter(label__startswith='kc:').only('pk', 'label')
+        }
+        deleted = _delete_stale_acls(document_ct=document_ct, desired_by_role=desired_by_role)
+
+        # 2) Upsert ACLs for all current grants.
+        skipped = 0
+        valid_mayan_user_ids: dict[str, int] = {}
+        for user_id, user_grants in grants_by_user.items():
+            try:
+                valid_mayan_user_ids[user_id] = int(mayan_user_ids.get(user_id))
+            except Exception:
+                skipped += len(user_grants)
+
+        roles_by_user = _ensure_user_groups_roles(valid_mayan_user_ids)
+
+        # (role pk, document id) -> desired StoredPermission pks
+        desired_acls: dict[tuple[int, int], set[int]] = {}
+        # role pk -> (role, union of StoredPermissions over all its grants)
+        role_perms: dict[int, tuple] = {}
+
+        for user_id in valid_mayan_user_ids:
+            role = roles_by_user.get(user_id)
+            if role is None:
+                # Mapped Mayan user no longer exists.
+                skipped += len(grants_by_user[user_id])
+                continue
 
-        existing_qs = AccessControlList.objects.filter(content_type=document_ct, role=role)
-        if desired_doc_ids:
-            stale_qs = existing_qs.exclude(object_id__in=desired_doc_ids)
+            for grant in grants_by_user[user_id]:
+                stored_perms = _resolve_perms(frozenset(grant.permissions))
+                desired_acls[(role.pk, grant.document_id)] = {p.pk for p in stored_perms}
+                role_perms.setdefault(role.pk, (role, set()))[1].update(stored_perms)
+
+        # Also ensure each Role has the same permissions globally (required by Mayan)
+        # This is safe because the role is per-user.
+        for role, perms in role_perms.values():
+            if perms:
+                role.permissions.add(*perms)
+
+        created, updated = _upsert_acls(document_ct=document_ct, desired_acls=desired_acls)
+
+    if version is not None:
+        # Grants expire through their Redis TTL without bumping grants:version,
+        # so the next full pass is due at the earliest expiry. A grant without
+        # a known expiry could vanish at any time: don't short-circuit at all.
+        expiries = [grant.expires_at for user_grants in grants_by_user.values() for grant in user_grants]
+        if None in expiries:
+            _LAST_SYNC = None
         else:
-            stale_qs = existing_qs
-
-        for acl in stale_qs:
-            acl.delete()
-            deleted += 1
-
-    # 2) Upsert ACLs for all current grants.
-    for user_id, user_grants in grants_by_user.items():
-        mayan_user_id_raw = r.get(f"mayan:user:{user_id}")
-        if not mayan_user_id_raw:
-            skipped += len(user_grants)
-            continue
-
-        try:
-            mayan_user_id = int(mayan_user_id_raw)
-        except Exception:
-            skipped += len(user_grants)
-            continue
-
-        role = _ensure_user_group_role(user_id=user_id, mayan_user_id=mayan_user_id)
-
-        for grant in user_grants:
-            permission_keys = _permission_keys_for_grant(grant)
-            stored_perms = _get_stored_permissions(permission_keys)
-
-            acl, was_created = AccessControlList.objects.get_or_create(
-                content_type=document_ct,
-                object_id=grant.document_id,
-                role=role,
-            )
-            acl.permissions.set(stored_perms)
-            if was_created:
-                created += 1
-            else:
-                updated += 1
-
-            # Also ensure the Role has the same permissions globally (required by Mayan)
-            # This is safe because the role is per-user.
-            if stored_perms:
-                role.permissions.add(*stored_perms)
+            _LAST_SYNC = (version, min(expiries, default=float("inf")))
 
     return {
         "created": created,
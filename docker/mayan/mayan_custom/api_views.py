@@ -8,9 +8,8 @@ import base64
 
 from django.contrib.auth import authenticate
 from django.http import JsonResponse
-from django.utils.decorators import method_decorator
-from django.views import View
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from mayan_custom.acl_sync import sync_acl_from_redis
 
@@ -30,19 +29,17 @@ def _basic_auth_user(request):
     return authenticate(request=request, username=username, password=password)
 
 
-@method_decorator(csrf_exempt, name='dispatch')
-class ACLSyncNowView(View):
-    http_method_names = ['post']
+@csrf_exempt
+@require_POST
+def acl_sync_now(request):
+    user = _basic_auth_user(request=request)
 
-    def post(self, request, *args, **kwargs):
-        user = _basic_auth_user(request=request)
+    if not user:
+        return JsonResponse({'detail': 'Unauthorized'}, status=401)
 
-        if not user:
-            return JsonResponse({'detail': 'Unauthorized'}, status=401)
+    # Staff/superusers only; this endpoint can grant/revoke document visibility.
+    if not (getattr(user, 'is_staff', False) or getattr(user, 'is_superuser', False)):
+        return JsonResponse({'detail': 'Forbidden'}, status=403)
 
-        # Staff/superusers only; this endpoint can grant/revoke document visibility.
-        if not (getattr(user, 'is_staff', False) or getattr(user, 'is_superuser', False)):
-            return JsonResponse({'detail': 'Forbidden'}, status=403)
-
-        stats = sync_acl_from_redis()
-        return JsonResponse({'ok': True, 'stats': stats})
+    stats = sync_acl_from_redis(force=True)
+    return JsonResponse({'ok': True, 'stats': stats})
@@ -66,7 +66,7 @@ class CustomOIDCConfig(AppConfig):
             from django.urls import re_path
 
             from mayan.urls import urlpatterns as mayan_urlpatterns
-            from mayan_custom.api_views import ACLSyncNowView
+            from mayan_custom.api_views import acl_sync_now
 
             already_registered = any(
                 getattr(pattern, 'name', None) == 'mayan_custom_acl_sync_now'
@@ -78,7 +78,7 @@ class CustomOIDCConfig(AppConfig):
                     re_path(
                         route=r'^api/custom/acl-sync/$',
                         name='mayan_custom_acl_sync_now',
-                        view=ACLSyncNowView.as_view(),
+                        view=acl_sync_now,
                     ),
                 )
         except Exception:
@@ -1,9 +1,17 @@
 from __future__ import annotations
 
+import re
+import time
 from urllib.parse import quote
 
+from django.conf import settings
 from django.shortcuts import redirect
 
+from mayan_custom.oidc_backend import refresh_session_tokens
+
+# Session key holding the last time the session expiry was extended.
+SESSION_TOUCHED_KEY = "_mayan_custom_last_touched"
+
 
 class AutoOIDCLoginMiddleware:
     """Redirect anonymous UI requests to OIDC SSO.
@@ -17,6 +25,10 @@ class AutoOIDCLoginMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
 
+        # SESSION_SAVE_EVERY_REQUEST is off; extend active sessions at most
+        # once per interval instead of writing the session on every request.
+        self.renew_interval = int(getattr(settings, "SESSION_RENEW_INTERVAL", 60 * 5))
+
         # Paths that must remain reachable without triggering an OIDC redirect.
         # - /api/ is used by our Node backend to talk to Mayan.
         # - /oidc/ is the OIDC flow itself.
@@ -34,36 +46,53 @@ class AutoOIDCLoginMiddleware:
             "/robots.txt",
         )
 
-    def __call__(self, request):
-        # Determine authentication with minimal assumptions about middleware order.
-        # - SessionMiddleware exposes request.session (preferred check)
-        # - AuthenticationMiddleware exposes request.user
-        try:
-            session = getattr(request, 'session', None)
-            if session and session.get('_auth_user_id'):
-                return self.get_response(request)
-        except Exception:
-            pass
-
-        user = getattr(request, "user", None)
-        if user is not None and getattr(user, 'is_authenticated', False):
-            return self.get_response(request)
+        # Single precompiled pattern instead of a per-request startswith() loop.
+        self._allow_re = re.compile(
+            "^(?:" + "|".join(re.escape(prefix) for prefix in self.allowed_prefixes) + ")"
+        )
 
+    def __call__(self, request):
         # Only redirect browser-style GET requests.
         if request.method != "GET":
             return self.get_response(request)
 
+        # Path checks come before any auth check: SessionMiddleware loads the
+        # session lazily, so excluded paths (/api/, /static/, ...) never hit
+        # the session backend because of this middleware.
         path = request.path or "/"
 
         if path in self.allowed_exact:
             return self.get_response(request)
 
-        if any(path.startswith(prefix) for prefix in self.allowed_prefixes):
+        if self._allow_re.match(path):
             return self.get_response(request)
 
         # Avoid loops if we're already being sent to the default login.
         if path.startswith("/authentication/"):
             return self.get_response(request)
 
+        # request.user is set lazily by AuthenticationMiddleware (installed
+        # before this middleware), so this is the only session access needed.
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            # Renew expiring OIDC tokens silently with the stored refresh token.
+            # A rejected refresh token logs the session out; fall through to
+            # the OIDC redirect in that case.
+            refresh_session_tokens(request)
+            if request.user.is_authenticated:
+                self._renew_session(request)
+                return self.get_response(request)
+
         next_url = request.get_full_path() or "/"
         return redirect(f"/oidc/authenticate/?next={quote(next_url)}")
+
+    def _renew_session(self, request):
+        session = getattr(request, "session", None)
+        if session is None:
+            return
+
+        now = int(time.time())
+        if now - session.get(SESSION_TOUCHED_KEY, 0) >= self.renew_interval:
+            # Marks the session modified, so SessionMiddleware saves it with a
+            # fresh expiry and re-sends the cookie.
+            session[SESSION_TOUCHED_KEY] = now
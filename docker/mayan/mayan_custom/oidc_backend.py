@@ -1,9 +1,291 @@
+import base64
+import json
+import logging
+import re
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from josepy.jwk import JWK
+from josepy.jws import JWS
 from mozilla_django_oidc.auth import OIDCAuthenticationBackend
+from mozilla_django_oidc.utils import import_from_settings
 
+from django.contrib import auth
 from django.contrib.auth.models import Group
+from django.core.cache import caches
+from django.core.exceptions import SuspiciousOperation
+from django.utils.encoding import force_bytes
+
+logger = logging.getLogger(__name__)
+
+# Keycloak JWKS, shared by all workers through the "oidc" Redis cache alias and
+# refreshed ahead of expiry by mayan_custom.tasks.refresh_oidc_jwks_task.
+JWKS_CACHE_KEY = "jwks"
+JWKS_MIN_TTL = 300
+
+
+def _max_age(response) -> int:
+    match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    return int(match.group(1)) if match else 0
+
+
+# Keycloak discovery document, shared through the same cache alias. Only the
+# backchannel endpoints listed in OIDC_OP_DISCOVERED_ENDPOINTS (those not set
+# explicitly in the environment) are taken from it, and only their paths:
+# Keycloak advertises its public hostname (KC_HOSTNAME_URL), which the Mayan
+# container usually can't reach, so the configured scheme and host are kept.
+DISCOVERY_CACHE_KEY = "discovery"
+DISCOVERY_MIN_TTL = 3600
+_DISCOVERY_FIELDS = {
+    "OIDC_OP_TOKEN_ENDPOINT": "token_endpoint",
+    "OIDC_OP_USER_ENDPOINT": "userinfo_endpoint",
+    "OIDC_OP_JWKS_ENDPOINT": "jwks_uri",
+}
+
+
+def fetch_discovery() -> dict:
+    """Return the realm's openid-configuration, from Redis when possible."""
+    cache = caches["oidc"]
+    document = cache.get(DISCOVERY_CACHE_KEY)
+    if document is not None:
+        return document
+
+    response = requests.get(
+        import_from_settings("OIDC_OP_DISCOVERY_ENDPOINT"),
+        verify=import_from_settings("OIDC_VERIFY_SSL", True),
+        timeout=import_from_settings("OIDC_TIMEOUT", None),
+        proxies=import_from_settings("OIDC_PROXY", None),
+    )
+    response.raise_for_status()
+    document = response.json()
+    cache.set(DISCOVERY_CACHE_KEY, document, timeout=max(_max_age(response), DISCOVERY_MIN_TTL))
+    return document
+
+
+def op_endpoint(name: str) -> str:
+    """Resolve an OIDC_OP_* endpoint, taking its path from the discovery document."""
+    configured = import_from_settings(name)
+    if name not in import_from_settings("OIDC_OP_DISCOVERED_ENDPOINTS", ()):
+        return configured
+
+    try:
+        discovered = fetch_discovery().get(_DISCOVERY_FIELDS[name])
+    except Exception:
+        # Keycloak unreachable: fall back to the configured default.
+        discovered = None
+    if not discovered:
+        return configured
+
+    base = urlsplit(configured)
+    return urlunsplit(urlsplit(discovered)._replace(scheme=base.scheme, netloc=base.netloc))
+
+
+def fetch_jwks(force: bool = False) -> dict:
+    """Return Keycloak's signing keys as {kid: jwk}, from Redis when possible."""
+    cache = caches["oidc"]
+    if not force:
+        keys = cache.get(JWKS_CACHE_KEY)
+        if keys is not None:
+            return keys
+
+    response = requests.get(
+        op_endpoint("OIDC_OP_JWKS_ENDPOINT"),
+        verify=import_from_settings("OIDC_VERIFY_SSL", True),
+        timeout=import_from_settings("OIDC_TIMEOUT", None),
+        proxies=import_from_settings("OIDC_PROXY", None),
+    )
+    response.raise_for_status()
+    keys = {str(jwk.get("kid")): jwk for jwk in response.json().get("keys", [])}
+    cache.set(JWKS_CACHE_KEY, keys, timeout=max(_max_age(response), JWKS_MIN_TTL))
+    return keys
+
+
+# kid -> (jwk dict, parsed josepy JWK). Avoids rebuilding the RSA public key
+# on every verification; an entry is rebuilt as soon as the JWKS for that kid
+# changes, so key rotation needs no explicit invalidation.
+_PARSED_JWKS: dict = {}
+
+
+def _parsed_jwk(key: dict):
+    kid = str(key.get("kid"))
+    entry = _PARSED_JWKS.get(kid)
+    if entry is None or entry[0] != key:
+        entry = (key, JWK.from_json(key))
+        _PARSED_JWKS[kid] = entry
+    return entry[1]
+
+
+def _jwt_header(token) -> dict:
+    segment = force_bytes(token).split(b".", 1)[0]
+    segment += b"=" * (-len(segment) % 4)
+    return json.loads(base64.urlsafe_b64decode(segment))
+
+
+def _match_jwk(keys: dict, kid, alg):
+    if import_from_settings("OIDC_VERIFY_KID", True):
+        candidates = [keys[kid]] if kid in keys else []
+    else:
+        candidates = list(keys.values())
+
+    for jwk in candidates:
+        if "alg" in jwk and jwk["alg"] != alg:
+            continue
+        return jwk
+    return None
+
+
+# Session keys for the silent refresh-token flow. `oidc_id_token_expiration`
+# is the key mozilla-django-oidc itself uses for OIDC_RENEW_ID_TOKEN_EXPIRY_SECONDS.
+REFRESH_TOKEN_SESSION_KEY = "oidc_refresh_token"
+EXPIRATION_SESSION_KEY = "oidc_id_token_expiration"
+# Delay before retrying after a transient refresh failure (Keycloak down, 5xx).
+REFRESH_RETRY_INTERVAL = 60
+
+
+def _oauth_error(response):
+    try:
+        return response.json().get("error")
+    except ValueError:
+        return None
+
+
+def _verified_id_token(token: str) -> bool:
+    # Same signature checks as the login callback. There is no nonce to
+    # compare on a refresh, so only the signature and audience are checked.
+    backend = MayanKeycloakOIDCBackend()
+    try:
+        payload = json.loads(backend.get_payload_data(token, backend.retrieve_matching_jwk(token)))
+    except Exception:
+        # Bad signature, unknown kid or malformed token: fail closed.
+        return False
+    aud = payload.get("aud")
+    audiences = aud if isinstance(aud, list) else [aud]
+    return backend.OIDC_RP_CLIENT_ID in audiences
+
+
+def refresh_session_tokens(request) -> bool:
+    """Renew the session's OIDC tokens with a backchannel refresh_token grant.
+
+    This is how a Keycloak-side logout, user disable or session timeout
+    reaches Mayan: once Keycloak rejects the refresh token (invalid_grant),
+    the Mayan session is logged out too. On success the stored ID token stays
+    current for the logout id_token_hint. Runs only once the renew interval
+    has elapsed and a refresh token is stored. Returns True when the tokens
+    were renewed.
+    """
+    session = getattr(request, "session", None)
+    if session is None:
+        return False
+
+    refresh_token = session.get(REFRESH_TOKEN_SESSION_KEY)
+    expiration = session.get(EXPIRATION_SESSION_KEY)
+    if not refresh_token or expiration is None or time.time() < expiration:
+        return False
+
+    # Concurrent requests of one session would all present the same refresh
+    # token; let only one of them refresh; the others carry on unchanged.
+    cache = caches["oidc"]
+    lock_key = f"refresh:{session.session_key}"
+    timeout = import_from_settings("OIDC_TIMEOUT", None)
+    if not cache.add(lock_key, 1, timeout=int(timeout or 30) + 5):
+        return False
+
+    try:
+        response = requests.post(
+            op_endpoint("OIDC_OP_TOKEN_ENDPOINT"),
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+                "client_id": import_from_settings("OIDC_RP_CLIENT_ID"),
+                "client_secret": import_from_settings("OIDC_RP_CLIENT_SECRET"),
+            },
+            verify=import_from_settings("OIDC_VERIFY_SSL", True),
+            timeout=timeout,
+            proxies=import_from_settings("OIDC_PROXY", None),
+        )
+        if response.status_code == 400 and _oauth_error(response) == "invalid_grant":
+            # The Keycloak session is gone: end the Mayan session as well.
+            auth.logout(request)
+            return False
+        response.raise_for_status()
+        token_info = response.json()
+    except (requests.RequestException, ValueError) as exc:
+        # Transient failure: keep the refresh token and retry a bit later.
+        logger.warning("OIDC(refresh): token refresh failed: %s", exc)
+        session[EXPIRATION_SESSION_KEY] = time.time() + REFRESH_RETRY_INTERVAL
+        return False
+    finally:
+        cache.delete(lock_key)
+
+    id_token = token_info.get("id_token")
+    if id_token and not _verified_id_token(id_token):
+        # Don't keep the session alive on tokens we can't trust: log out so
+        # the middleware sends the user back through the OIDC flow.
+        logger.error("OIDC(refresh): refreshed ID token failed verification")
+        auth.logout(request)
+        return False
+
+    if import_from_settings("OIDC_STORE_ACCESS_TOKEN", False) and token_info.get("access_token"):
+        session["oidc_access_token"] = token_info["access_token"]
+    if import_from_settings("OIDC_STORE_ID_TOKEN", False) and id_token:
+        session["oidc_id_token"] = id_token
+    session[REFRESH_TOKEN_SESSION_KEY] = token_info.get("refresh_token") or refresh_token
+    session[EXPIRATION_SESSION_KEY] = time.time() + import_from_settings(
+        "OIDC_RENEW_ID_TOKEN_EXPIRY_SECONDS", 60 * 15
+    )
+    return True
 
 
 class MayanKeycloakOIDCBackend(OIDCAuthenticationBackend):
+    def get_token(self, payload):
+        # get_token starts the backchannel part of authenticate(); resolve the
+        # token/userinfo endpoints here so get_userinfo sees the same values.
+        self.OIDC_OP_TOKEN_ENDPOINT = op_endpoint("OIDC_OP_TOKEN_ENDPOINT")
+        self.OIDC_OP_USER_ENDPOINT = op_endpoint("OIDC_OP_USER_ENDPOINT")
+
+        # Keep the refresh token so sessions can be renewed over the backchannel
+        # (see refresh_session_tokens) instead of a full redirect through Keycloak.
+        token_info = super().get_token(payload)
+        session = getattr(getattr(self, "request", None), "session", None)
+        if session is not None and token_info.get("refresh_token"):
+            session[REFRESH_TOKEN_SESSION_KEY] = token_info["refresh_token"]
+        return token_info
+
+    def retrieve_matching_jwk(self, token):
+        # Same matching rules as upstream, but the JWKS comes from the shared
+        # Redis cache instead of an HTTP request per verification. An unknown
+        # kid usually means Keycloak rotated its keys: refetch once.
+        header = _jwt_header(token)
+        kid, alg = header.get("kid"), header.get("alg")
+        for force in (False, True):
+            jwk = _match_jwk(fetch_jwks(force=force), kid, alg)
+            if jwk is not None:
+                return jwk
+        raise SuspiciousOperation("Could not find a valid JWKS.")
+
+    def _verify_jws(self, payload, key):
+        # Upstream rebuilds the JWK from its JSON form on every call; reuse the
+        # parsed key instead. Other key types (PEM strings) keep upstream behavior.
+        if not isinstance(key, dict):
+            return super()._verify_jws(payload, key)
+
+        jws = JWS.from_compact(payload)
+        try:
+            alg = jws.signature.combined.alg.name
+        except KeyError:
+            raise SuspiciousOperation("No alg value found in header")
+
+        if alg != self.OIDC_RP_SIGN_ALGO:
+            raise SuspiciousOperation(
+                "The provider algorithm {!r} does not match the client's "
+                "OIDC_RP_SIGN_ALGO.".format(alg)
+            )
+
+        if not jws.verify(_parsed_jwk(key)):
+            raise SuspiciousOperation("JWS token verification failed.")
+        return jws.payload
+
     def _sync_user_groups(self, user, claims):
         roles = []
         realm_access = claims.get("realm_access")
@@ -32,6 +32,34 @@ OIDC_STATE_MAX_AGE = 600  # 10 minutes
 
 logger = logging.getLogger(__name__)
 
+# Resolved once per process; the callback route never changes at runtime.
+_CALLBACK_PATH = None
+
+
+def _callback_path():
+    global _CALLBACK_PATH
+    if _CALLBACK_PATH is None:
+        _CALLBACK_PATH = reverse("oidc_authentication_callback")
+    return _CALLBACK_PATH
+
+
+def keycloak_logout_url(request):
+    """Return Keycloak's end-session URL (OIDC_OP_LOGOUT_URL_METHOD).
+
+    Called by mozilla-django-oidc's logout view before the local session is
+    cleared, so the stored ID token can still be sent as a hint.
+    """
+    params = {
+        "client_id": import_from_settings("OIDC_RP_CLIENT_ID"),
+        "post_logout_redirect_uri": request.build_absolute_uri(
+            import_from_settings("LOGOUT_REDIRECT_URL", "/")
+        ),
+    }
+    id_token = getattr(request, "session", {}).get("oidc_id_token")
+    if id_token:
+        params["id_token_hint"] = id_token
+    return f"{import_from_settings('OIDC_OP_LOGOUT_ENDPOINT')}?{urlencode(params)}"
+
 
 class CookieBasedOIDCAuthenticationRequestView(BaseAuthRequestView):
     """
@@ -48,9 +76,7 @@ class CookieBasedOIDCAuthenticationRequestView(BaseAuthRequestView):
             "response_type": "code",
             "scope": import_from_settings("OIDC_RP_SCOPES", "openid profile email"),
             "client_id": import_from_settings("OIDC_RP_CLIENT_ID"),
-            "redirect_uri": request.build_absolute_uri(
-                reverse("oidc_authentication_callback")
-            ),
+            "redirect_uri": f"{request.scheme}://{request.get_host()}{_callback_path()}",
             "state": state,
             "nonce": nonce,
         }
@@ -76,8 +102,8 @@ class CookieBasedOIDCAuthenticationRequestView(BaseAuthRequestView):
                 "code_verifier": None,
             }
             request.session["oidc_login_next"] = state_data["next"]
+            # SessionMiddleware persists modified sessions on the response.
             request.session.modified = True
-            request.session.save()
         except Exception:
             # Session storage issues should not prevent starting the flow.
             pass
@@ -175,7 +201,6 @@ class CookieBasedOIDCAuthenticationCallbackView(BaseCallbackView):
                     try:
                         del request.session["oidc_states"][url_state]
                         request.session.modified = True
-                        request.session.save()
                     except Exception:
                         pass
                     self.user = auth.authenticate(
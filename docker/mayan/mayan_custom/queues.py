@@ -23,3 +23,10 @@ queue_mayan_custom_periodic.add_task_type(
     name='mayan_custom_sync_acl_from_redis',
     schedule=timedelta(seconds=30),
 )
+
+queue_mayan_custom_periodic.add_task_type(
+    dotted_path='mayan_custom.tasks.refresh_oidc_jwks_task',
+    label=_(message='Refresh the cached Keycloak JWKS'),
+    name='mayan_custom_refresh_oidc_jwks',
+    schedule=timedelta(minutes=5),
+)
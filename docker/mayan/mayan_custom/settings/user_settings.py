@@ -12,6 +12,11 @@ OIDC_CALLBACK_CLASS = 'mayan_custom.oidc_views.CookieBasedOIDCAuthenticationCall
 from mayan.settings.production import *  # noqa
 
 import os
+import types
+
+# Snapshot the environment once into a read-only plain mapping; lookups are
+# plain dict gets instead of going through os.environ's encode/decode wrapper.
+_ENV = types.MappingProxyType(dict(os.environ))
 
 # =============================================================================
 # DISABLE GPG/DOCUMENT SIGNATURES (Fixes BrokenPipeError with PNG files)
@@ -67,36 +72,74 @@ if 'AUTHENTICATION_BACKENDS' in globals():
 else:
     _backends = ('django.contrib.auth.backends.ModelBackend',)
 
-if _OIDC_BACKEND not in _backends:
-    AUTHENTICATION_BACKENDS = _backends + (_OIDC_BACKEND,)
-else:
-    AUTHENTICATION_BACKENDS = _backends
+AUTHENTICATION_BACKENDS = _backends if _OIDC_BACKEND in set(_backends) else (*_backends, _OIDC_BACKEND)
+
+# =============================================================================
+# DATABASE CONNECTIONS
+# =============================================================================
+# Keep Postgres connections open between requests instead of reconnecting on
+# every request. Each Gunicorn/Celery worker process holds at most one
+# connection, so keep workers x processes below Postgres max_connections.
+# A CONN_MAX_AGE already present in DATABASES wins, including None (unlimited
+# persistence). Only Django's default of 0 is replaced, by the compose-level
+# MAYAN_DATABASES_CONN_MAX_AGE knob (read here only), defaulting to 60 seconds.
+if 'DATABASES' in globals() and 'default' in DATABASES:
+    _conn_max_age = DATABASES['default'].get('CONN_MAX_AGE', 0)
+    if _conn_max_age == 0:  # None (unlimited) != 0, so it is kept
+        DATABASES['default']['CONN_MAX_AGE'] = int(_ENV.get('MAYAN_DATABASES_CONN_MAX_AGE', '60'))
+    # Django >= 4.1: verify a reused connection is alive before using it.
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+    # gevent Gunicorn workers are opt-in (MAYAN_GUNICORN_WORKER_CLASS=gevent,
+    # with psycogreen installed through MAYAN_PIP_INSTALLS). psycopg is only
+    # cooperative once psycogreen has patched it; without that every query
+    # blocks the whole worker. Connections are per-greenlet there and would be
+    # left open by finished greenlets, so only persist them in other workers.
+    try:
+        from gevent import monkey as _gevent_monkey
+        if _gevent_monkey.is_module_patched('threading'):
+            DATABASES['default']['CONN_MAX_AGE'] = 0
+            try:
+                from psycogreen.gevent import patch_psycopg
+                patch_psycopg()
+            except ImportError:
+                pass
+    except ImportError:
+        pass
 
 # =============================================================================
 # Keycloak OIDC Configuration for mozilla-django-oidc
 # =============================================================================
 # Client credentials
-OIDC_RP_CLIENT_ID = os.environ.get('OIDC_RP_CLIENT_ID', 'mayan-edms')
-OIDC_RP_CLIENT_SECRET = os.environ.get('OIDC_RP_CLIENT_SECRET', 'mayan-edms-secret-key-2024')
+OIDC_RP_CLIENT_ID = _ENV.get('OIDC_RP_CLIENT_ID', 'mayan-edms')
+OIDC_RP_CLIENT_SECRET = _ENV.get('OIDC_RP_CLIENT_SECRET', 'mayan-edms-secret-key-2024')
 
 # Keycloak server URLs
 # Use browser-accessible URLs (localhost:8081) for authorization
 # Use internal Docker URLs (keycloak:8080) for backend token requests
-OIDC_OP_AUTHORIZATION_ENDPOINT = os.environ.get(
+_KC_INTERNAL = _ENV.get('KEYCLOAK_INTERNAL_URL', 'http://keycloak:8080')
+_KC_OIDC_PATH = '/realms/coffre-fort/protocol/openid-connect'
+
+OIDC_OP_AUTHORIZATION_ENDPOINT = _ENV.get(
     'OIDC_OP_AUTHORIZATION_ENDPOINT',
-    'http://localhost:8081/realms/coffre-fort/protocol/openid-connect/auth'
-)
-OIDC_OP_TOKEN_ENDPOINT = os.environ.get(
-    'OIDC_OP_TOKEN_ENDPOINT',
-    'http://keycloak:8080/realms/coffre-fort/protocol/openid-connect/token'
+    f'http://localhost:8081{_KC_OIDC_PATH}/auth'
 )
-OIDC_OP_USER_ENDPOINT = os.environ.get(
-    'OIDC_OP_USER_ENDPOINT',
-    'http://keycloak:8080/realms/coffre-fort/protocol/openid-connect/userinfo'
+OIDC_OP_TOKEN_ENDPOINT = _ENV.get('OIDC_OP_TOKEN_ENDPOINT', f'{_KC_INTERNAL}{_KC_OIDC_PATH}/token')
+OIDC_OP_USER_ENDPOINT = _ENV.get('OIDC_OP_USER_ENDPOINT', f'{_KC_INTERNAL}{_KC_OIDC_PATH}/userinfo')
+OIDC_OP_JWKS_ENDPOINT = _ENV.get('OIDC_OP_JWKS_ENDPOINT', f'{_KC_INTERNAL}{_KC_OIDC_PATH}/certs')
+
+# Backchannel endpoints that are not set explicitly above take their path from
+# the realm's discovery document (cached in Redis, see mayan_custom.oidc_backend)
+# while keeping the internal Keycloak host of the defaults above. The defaults
+# remain the fallback if discovery is unavailable. docker-compose.yml sets all
+# three explicitly, so this only applies when they are left unset.
+OIDC_OP_DISCOVERY_ENDPOINT = _ENV.get(
+    'OIDC_OP_DISCOVERY_ENDPOINT',
+    f'{_KC_INTERNAL}/realms/coffre-fort/.well-known/openid-configuration'
 )
-OIDC_OP_JWKS_ENDPOINT = os.environ.get(
-    'OIDC_OP_JWKS_ENDPOINT',
-    'http://keycloak:8080/realms/coffre-fort/protocol/openid-connect/certs'
+OIDC_OP_DISCOVERED_ENDPOINTS = tuple(
+    name for name in ('OIDC_OP_TOKEN_ENDPOINT', 'OIDC_OP_USER_ENDPOINT', 'OIDC_OP_JWKS_ENDPOINT')
+    if name not in _ENV
 )
 
 # Signing algorithm used by Keycloak
@@ -109,15 +152,40 @@ LOGIN_REDIRECT_URL_FAILURE = '/authentication/login/'
 LOGOUT_REDIRECT_URL = '/'
 
 # =============================================================================
-# SESSION CONFIGURATION - Use database backend for multi-worker Gunicorn
+# SESSION CONFIGURATION - Redis-cached database sessions for multi-worker Gunicorn
 # =============================================================================
-# CRITICAL: Must use database sessions to share state across Gunicorn workers
+# CRITICAL: Sessions must be shared across Gunicorn workers
 # File-based sessions fail with multiple workers (each worker has different view)
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# cached_db reads sessions from Redis and only falls back to Postgres on a
+# cache miss, so a Redis restart doesn't log everyone out.
+# Sessions live in their own Redis (redis-sessions in docker-compose.yml): the
+# main instance evicts with allkeys-lru and holds the authoritative grant:*
+# and mayan:user:* keys, which session growth must never push out.
+_SESSION_REDIS_URL = _ENV.get('SESSION_CACHE_REDIS_URL') or 'redis://redis-sessions:6379/0'
+if not _SESSION_REDIS_URL.startswith(('redis://', 'rediss://')):
+    _SESSION_REDIS_URL = 'redis://redis-sessions:6379/0'
+
+CACHES = dict(globals().get('CACHES') or {})
+CACHES.setdefault('default', {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'})
+CACHES['sessions'] = {
+    'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+    'LOCATION': _SESSION_REDIS_URL,
+}
+# OIDC metadata (JWKS) shared by all Gunicorn workers and Celery workers.
+CACHES['oidc'] = {
+    'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+    'LOCATION': CACHES['sessions']['LOCATION'],
+    'KEY_PREFIX': 'oidc',
+}
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
 
 # Session cookie settings - critical for OIDC state preservation
 SESSION_COOKIE_AGE = 60 * 60 * 24 * 30  # 30 days
-SESSION_SAVE_EVERY_REQUEST = True
+# Don't rewrite the session on every request; AutoOIDCLoginMiddleware renews
+# the expiry of active sessions at most once per SESSION_RENEW_INTERVAL.
+SESSION_SAVE_EVERY_REQUEST = False
+SESSION_RENEW_INTERVAL = 60 * 5  # 5 minutes
 SESSION_COOKIE_SAMESITE = False  # Disable SameSite to allow cross-origin redirects
 SESSION_COOKIE_SECURE = False  # Set True in production with HTTPS
 SESSION_COOKIE_HTTPONLY = True
@@ -147,6 +215,10 @@ OIDC_USERNAME_CLAIM = 'preferred_username'
 # Allow session renewal via OIDC
 OIDC_RENEW_ID_TOKEN_EXPIRY_SECONDS = 60 * 15  # 15 minutes
 
+# Bound every backchannel call to Keycloak (token, userinfo, JWKS, discovery,
+# refresh). Some of them run on the UI request path.
+OIDC_TIMEOUT = 5  # seconds
+
 # =============================================================================
 # Additional OIDC Settings for True SSO
 # =============================================================================
@@ -155,21 +227,23 @@ OIDC_STORE_ACCESS_TOKEN = True
 OIDC_STORE_ID_TOKEN = True
 
 # Verify SSL in production (disable for local dev with self-signed certs)
-OIDC_VERIFY_SSL = os.environ.get('OIDC_VERIFY_SSL', 'False').lower() == 'true'
+OIDC_VERIFY_SSL = _ENV.get('OIDC_VERIFY_SSL', 'False').lower() == 'true'
 
 # Scopes to request from Keycloak
 OIDC_RP_SCOPES = 'openid profile email'
 
-# Logout endpoint
-OIDC_OP_LOGOUT_URL_METHOD = 'mozilla_django_oidc.views.OIDCAuthenticationCallbackView'
+# Logout: mozilla-django-oidc calls this function to get the URL the browser is
+# sent to after the local logout, i.e. Keycloak's browser-facing end-session endpoint.
+OIDC_OP_LOGOUT_ENDPOINT = _ENV.get(
+    'OIDC_OP_LOGOUT_ENDPOINT',
+    OIDC_OP_AUTHORIZATION_ENDPOINT.rsplit('/', 1)[0] + '/logout'
+)
+OIDC_OP_LOGOUT_URL_METHOD = 'mayan_custom.oidc_views.keycloak_logout_url'
 
 # Map Keycloak roles to Django groups/permissions
 # Custom claim containing roles from Keycloak
 OIDC_GROUPS_CLAIM = 'groups'
 
-# Use email as fallback for username
-OIDC_USE_NONCE = True
-
 # =============================================================================
 # Default-to-SSO behavior
 # =============================================================================
@@ -177,13 +251,30 @@ OIDC_USE_NONCE = True
 # IMPORTANT: The middleware explicitly excludes /api/* so backend Mayan API calls
 # keep working without getting 302 redirects.
 _AUTO_OIDC_MIDDLEWARE = 'mayan_custom.middleware.AutoOIDCLoginMiddleware'
-if 'MIDDLEWARE' in globals():
-    if _AUTO_OIDC_MIDDLEWARE not in MIDDLEWARE:
-        _mw = list(MIDDLEWARE)
-        # Needs request.session, so it must run AFTER SessionMiddleware.
-        try:
-            _session_idx = _mw.index('django.contrib.sessions.middleware.SessionMiddleware')
-            _mw.insert(_session_idx + 1, _AUTO_OIDC_MIDDLEWARE)
-        except ValueError:
-            _mw.append(_AUTO_OIDC_MIDDLEWARE)
-        MIDDLEWARE = tuple(_mw)
+if 'MIDDLEWARE' in globals() and _AUTO_OIDC_MIDDLEWARE not in set(MIDDLEWARE):
+    _mw = list(MIDDLEWARE)
+    # Needs request.user, so it must run AFTER AuthenticationMiddleware
+    # (or last, if that middleware isn't found).
+    _insert_idx = next(
+        (
+            _idx + 1 for _idx, _name in enumerate(_mw)
+            if _name == 'django.contrib.auth.middleware.AuthenticationMiddleware'
+        ),
+        len(_mw),
+    )
+    _mw.insert(_insert_idx, _AUTO_OIDC_MIDDLEWARE)
+    MIDDLEWARE = tuple(_mw)
+
+# =============================================================================
+# LOGGING
+# =============================================================================
+# Let INFO records of the mayan_custom namespace (e.g. the periodic "ACL sync
+# stats" line) through; handlers and propagation stay as Mayan configures them.
+LOGGING = dict(globals().get('LOGGING') or {'version': 1, 'disable_existing_loggers': False})
+LOGGING['loggers'] = {
+    **LOGGING.get('loggers', {}),
+    'mayan_custom': {
+        **LOGGING.get('loggers', {}).get('mayan_custom', {}),
+        'level': 'INFO',
+    },
+}
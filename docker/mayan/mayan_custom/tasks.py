@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import logging
+
 from celery import shared_task
 
+logger = logging.getLogger(__name__)
+
 
 @shared_task(bind=True, ignore_result=True)
 def sync_acl_from_redis_task(self):
@@ -10,4 +14,12 @@ def sync_acl_from_redis_task(self):
 
     stats = sync_acl_from_redis()
     # Keep logs short but useful.
-    print(f"[mayan_custom] ACL sync stats: {stats}")
+    logger.info("ACL sync stats: %s", stats)
+
+
+@shared_task(bind=True, ignore_result=True)
+def refresh_oidc_jwks_task(self):
+    # Refresh-ahead: keep the shared JWKS cache warm so logins never wait on Keycloak.
+    from mayan_custom.oidc_backend import fetch_jwks
+
+    fetch_jwks(force=True)
@@ -6,9 +6,7 @@ from mayan.settings.production import *  # noqa
 import os
 
 # Add social auth to installed apps
-INSTALLED_APPS = list(INSTALLED_APPS) + [
-    'social_django',
-]
+INSTALLED_APPS = (*INSTALLED_APPS, 'social_django')
 
 # Configure authentication backends
 # Keep the default Mayan backend and add Keycloak OIDC
@@ -1,11 +1,21 @@
+import logging
 import os
 import re
 import sys
 import time
 import html
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    # Optional: parse the login page in a single C-level pass.
+    from lxml import html as lxml_html
+except ImportError:
+    # Fall back to regex scraping below.
+    lxml_html = None
 
 
 MAYAN_BASE = os.getenv("MAYAN_BASE", "http://localhost:8000")
@@ -17,12 +27,33 @@ TIMEOUT = float(os.getenv("SSO_TIMEOUT", "15"))
 RETRIES = int(os.getenv("SSO_RETRIES", "30"))
 SLEEP = float(os.getenv("SSO_RETRY_SLEEP", "1"))
 
+logger = logging.getLogger(__name__)
+
+# Regex fallback for the Keycloak login form when lxml isn't installed.
+# Compiled once and matched against the raw bytes to skip decoding the page.
+_FORM_RE = re.compile(rb'<form[^>]+id="kc-form-login"[^>]+action="([^"]+)"')
+_HIDDEN_RE = re.compile(rb'<input[^>]+type="hidden"[^>]+name="([^"]+)"[^>]+value="([^"]*)"')
+
+# Keep-alive connections shared by every session below (urllib3's pool is
+# thread-safe). Cookie jars are not shared: readiness polling must not seed
+# Mayan/Keycloak cookies into the login flow, which has to start clean.
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+
+
+def _new_session() -> requests.Session:
+    session = requests.Session()
+    session.mount("http://", _ADAPTER)
+    session.mount("https://", _ADAPTER)
+    return session
+
 
 def wait_http_ok(url: str) -> None:
+    # One session per call: wait_http_ok runs in several threads at once.
+    session = _new_session()
     last_exc: Exception | None = None
     for _ in range(RETRIES):
         try:
-            r = requests.get(url, timeout=TIMEOUT)
+            r = session.get(url, timeout=TIMEOUT)
             if r.status_code < 500:
                 return
         except Exception as exc:
@@ -38,47 +69,68 @@ def get_keycloak_login_form(session: requests.Session, auth_url: str) -> tuple[s
 
     set_cookie = r.headers.get("Set-Cookie")
     if set_cookie:
-        print("Keycloak Set-Cookie (first response header):", set_cookie[:200])
+        logger.info("Keycloak Set-Cookie (first response header): %s", set_cookie[:200])
 
     # Dump cookies currently in the session (helps debug Keycloak cookie_not_found)
     try:
         jar = list(session.cookies)
         if jar:
-            print("Session cookies after login page:")
-            for c in jar:
-                print(f"  {c.name} domain={c.domain} path={c.path} secure={c.secure}")
+            logger.info(
+                "Session cookies after login page:\n%s",
+                "\n".join(f"  {c.name} domain={c.domain} path={c.path} secure={c.secure}" for c in jar),
+            )
         else:
-            print("Session cookies after login page: (none)")
+            logger.info("Session cookies after login page: (none)")
     except Exception:
         pass
 
+    if lxml_html is not None:
+        tree = lxml_html.fromstring(r.content)
+        try:
+            form = tree.get_element_by_id("kc-form-login")
+        except KeyError:
+            raise RuntimeError("Could not find Keycloak login form (kc-form-login)")
+
+        # lxml decodes entities such as &amp; in the action URL itself.
+        action = form.get("action") or ""
+        action_url = action if action.startswith("http") else urljoin(KEYCLOAK_BASE, action)
+        hidden_inputs = {
+            i.get("name"): i.get("value", "")
+            for i in form.iterfind(".//input[@type='hidden']")
+            if i.get("name")
+        }
+        return action_url, hidden_inputs
+
     # Find the Keycloak login form action
     # Example: <form id="kc-form-login" ... action="/realms/.../login-actions/authenticate?..." method="post">
-    m = re.search(r"<form[^>]+id=\"kc-form-login\"[^>]+action=\"([^\"]+)\"", r.text)
+    m = _FORM_RE.search(r.content)
     if not m:
         raise RuntimeError("Could not find Keycloak login form (kc-form-login)")
 
     # Keycloak's HTML often entity-escapes query params as &amp;.
     # If we don't unescape, we post to a broken URL (amp;execution=...),
     # and Keycloak will not authenticate.
-    action = html.unescape(m.group(1))
+    action = html.unescape(m.group(1).decode("utf-8"))
     action_url = action if action.startswith("http") else urljoin(KEYCLOAK_BASE, action)
 
     # Collect hidden inputs (some realms/themes include them)
-    hidden_inputs = dict(re.findall(r"<input[^>]+type=\"hidden\"[^>]+name=\"([^\"]+)\"[^>]+value=\"([^\"]*)\"", r.text))
+    hidden_inputs = {
+        name.decode("utf-8"): value.decode("utf-8")
+        for name, value in _HIDDEN_RE.findall(r.content)
+    }
     return action_url, hidden_inputs
 
 
 def main() -> int:
-    print(f"Mayan: {MAYAN_BASE}")
-    print(f"Keycloak: {KEYCLOAK_BASE}")
-    print(f"User: {USERNAME}")
+    logger.info("Mayan: %s", MAYAN_BASE)
+    logger.info("Keycloak: %s", KEYCLOAK_BASE)
+    logger.info("User: %s", USERNAME)
 
-    # Wait for services to be up
-    wait_http_ok(f"{MAYAN_BASE}/authentication/login/")
-    wait_http_ok(f"{KEYCLOAK_BASE}/realms/coffre-fort/")
+    # Wait for services to be up (both polled concurrently)
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        list(ex.map(wait_http_ok, [f"{MAYAN_BASE}/authentication/login/", f"{KEYCLOAK_BASE}/realms/coffre-fort/"]))
 
-    s = requests.Session()
+    s = _new_session()
     s.headers.update(
         {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -100,7 +152,7 @@ def main() -> int:
     if auth_url.startswith("/"):
         auth_url = urljoin(KEYCLOAK_BASE, auth_url)
 
-    print("Auth URL:", auth_url)
+    logger.info("Auth URL: %s", auth_url)
 
     # Step 2: Keycloak login
     action_url, hidden = get_keycloak_login_form(s, auth_url)
@@ -118,24 +170,25 @@ def main() -> int:
 
     r1 = s.post(action_url, data=payload, allow_redirects=True, timeout=TIMEOUT)
     final_url = r1.url
-    print("POST status:", r1.status_code)
+    logger.info("POST status: %s", r1.status_code)
     if r1.history:
-        print("Redirect chain:")
+        chain = ["Redirect chain:"]
         for h in r1.history:
-            print(" ", h.status_code, h.url)
+            chain.append(f"  {h.status_code} {h.url}")
             loc = h.headers.get("Location")
             if loc:
-                print("    Location:", loc)
+                chain.append(f"    Location: {loc}")
+        logger.info("\n".join(chain))
     loc_final = r1.headers.get("Location")
     if loc_final:
-        print("Final Location header:", loc_final)
-    print("Final URL:", final_url)
+        logger.info("Final Location header: %s", loc_final)
+    logger.info("Final URL: %s", final_url)
 
     # If we are still on Keycloak after posting credentials, surface a useful error.
     if final_url.startswith(KEYCLOAK_BASE):
         page = (r1.text or "")
-        print("Final response content-type:", r1.headers.get("Content-Type"))
-        print("Final response body prefix:", page[:300].replace("\n", " "))
+        logger.info("Final response content-type: %s", r1.headers.get("Content-Type"))
+        logger.info("Final response body prefix: %s", page[:300].replace("\n", " "))
         # Common Keycloak error markers
         if "Invalid username or password" in page:
             raise RuntimeError("Keycloak rejected credentials (invalid username or password)")
@@ -154,13 +207,14 @@ def main() -> int:
     if r2.status_code != 200:
         raise RuntimeError(f"Unexpected status for Mayan root after login: {r2.status_code}")
 
-    print("OK: Mayan root returned 200 and did not redirect (SSO session established).")
+    logger.info("OK: Mayan root returned 200 and did not redirect (SSO session established).")
     return 0
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
     try:
         raise SystemExit(main())
     except Exception as exc:
-        print("SSO E2E FAILED:", exc)
+        logger.error("SSO E2E FAILED: %s", exc)
         sys.exit(1)